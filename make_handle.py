@@ -1,10 +1,11 @@
+import functools
 import math
 import sys
 import traceback
 
 import bmesh
-import mathutils
 import bpy
+import numpy as np
 
 
 bl_info = {
@@ -40,87 +41,184 @@ def rotate_list(the_list, n):
 
 def get_centroid(face):
     """Compute the centroid of a face."""
-    result = mathutils.Vector()
-    for vertex in face.verts:
-        result += vertex.co
-    return result / len(face.verts)
+    return face.calc_center_median()
+
+
+def get_rotation_matrices(old_normal, new_normals):
+    """Given a normal and an (n, 3) array of new normals, return an (n, 3, 3) array of
+    the matrices of the rotations that take the direction of old_normal to the
+    direction of each of the new normals, about the axis orthogonal to both."""
+    old_normal_normalized = old_normal / np.linalg.norm(old_normal)
+    new_normals_normalized = new_normals / np.linalg.norm(new_normals, axis=1, keepdims=True)
+    cos_angles = new_normals_normalized @ old_normal_normalized
+    result = np.tile(np.eye(3), (len(cos_angles), 1, 1))
+    # If the old and new normals are either nearly identical or in opposite directions,
+    # we leave them alone. The dot product alone is enough to tell, so we only compute
+    # cross products for the normals that actually need rotating.
+    rotating = cos_angles * cos_angles <= 1 - 1e-3
+    if not rotating.any():
+        return result
+    cos_angles = cos_angles[rotating]
+    axes = np.cross(old_normal_normalized, new_normals_normalized[rotating])
+    sin_angles = np.linalg.norm(axes, axis=1)
+    axes /= sin_angles[:, np.newaxis]
+    # Rodrigues' rotation formula. The sine and cosine of the angle are already known
+    # from the cross and dot products, so the angle itself is never needed.
+    cross_product_matrices = np.zeros((len(axes), 3, 3))
+    cross_product_matrices[:, 0, 1] = -axes[:, 2]
+    cross_product_matrices[:, 0, 2] = axes[:, 1]
+    cross_product_matrices[:, 1, 0] = axes[:, 2]
+    cross_product_matrices[:, 1, 2] = -axes[:, 0]
+    cross_product_matrices[:, 2, 0] = -axes[:, 1]
+    cross_product_matrices[:, 2, 1] = axes[:, 0]
+    result[rotating] += (
+        sin_angles[:, np.newaxis, np.newaxis] * cross_product_matrices
+        + (1 - cos_angles)[:, np.newaxis, np.newaxis]
+        * (cross_product_matrices @ cross_product_matrices)
+    )
+    return result
 
 
 def rotate_polygon_to_new_normal(vertices, old_normal, new_normal):
-    """Given a set of vertex coordinates, a face normal and a new normal, return
-    a new set of vertex coordinates that are rotated so the normal matches the new
-    normal."""
-    old_normal_normalized = old_normal.normalized()
-    new_normal_normalized = new_normal.normalized()
-    axis = old_normal_normalized.cross(new_normal_normalized)
-    if axis.length_squared < 1e-3:
-        # If the cross product is close to a zero vector, the old and new normals
-        # are either nearly identical or in opposite directions.
-        return vertices[:]
-    cos_angle = old_normal_normalized.dot(new_normal_normalized)
-    sin_angle = axis.length
-    angle = math.atan2(sin_angle, cos_angle)
-    quaternion = mathutils.Quaternion(axis, angle)
-    return [quaternion.to_matrix() @ vertex for vertex in vertices]
+    """Given an (N, 3) array of vertex coordinates, a face normal and a new normal,
+    return a new array of vertex coordinates that are rotated so the normal matches
+    the new normal."""
+    rotation_matrix = get_rotation_matrices(old_normal, new_normal[np.newaxis])[0]
+    return vertices @ rotation_matrix.T
 
 
 def convert_polygon_to_polar(vertices, x_axis, y_axis):
-    """Project the given vertices on to the plane formed by the given x-axis and y-axis
-    and represent them in polar form."""
-    result = []
-    last_angle = 0.0
-    for vertex in vertices:
-        cos_angle = vertex.dot(x_axis)
-        sin_angle = vertex.dot(y_axis)
-        radius = vertex.length
-        angle = math.atan2(sin_angle, cos_angle)
-        while angle < last_angle:
-            angle += 2 * math.pi
-        result.append((radius, angle))
-        last_angle = angle
-    return result
+    """Project the given (N, 3) array of vertices on to the plane formed by the given
+    x-axis and y-axis and represent them in polar form, as an (N, 2) array of radii and
+    angles. The angles are made nondecreasing by adding multiples of 2pi."""
+    cos_angles = vertices @ x_axis
+    sin_angles = vertices @ y_axis
+    radii = np.linalg.norm(vertices, axis=1)
+    angles = np.arctan2(sin_angles, cos_angles)
+    # Each angle is the smallest angle not less than the previous one (or zero, for the
+    # first angle) that points in the right direction.
+    angles = np.cumsum(np.diff(angles, prepend=0.0) % (2 * math.pi))
+    return np.stack([radii, angles], axis=1)
 
 
 def convert_polar_to_polygon(polar_polygon, x_axis, y_axis):
-    result = []
-    for radius, angle in polar_polygon:
-        point = radius * (x_axis * math.cos(angle) + y_axis * math.sin(angle))
-        result.append(point)
+    radii = polar_polygon[..., 0, np.newaxis]
+    angles = polar_polygon[..., 1, np.newaxis]
+    result = np.cos(angles) * x_axis
+    result += np.sin(angles) * y_axis
+    result *= radii
     return result
 
 
 def interpolate_polar_polygons(polar_polygon_1, polar_polygon_2, t):
-    result = []
-    for i in range(len(polar_polygon_1)):
-        result.append((
-            polar_polygon_1[i][0] * (1 - t) + polar_polygon_2[i][0] * t,
-            polar_polygon_1[i][1] * (1 - t) + polar_polygon_2[i][1] * t
-        ))
-    return result
-
-
-def get_handle_centroid(centroid_1, normal_1, centroid_2, normal_2, t, weight_1, weight_2):
-    """Given the centroids and normals of two faces, compute the centroid of an
-    intermediate face parametrized by the variable 0 <= t <= 1. The weight parameter
-    controls how much the handle sticks out."""
-    return (
-        centroid_1 * hermite_1(t)
-        + centroid_2 * hermite_1(1 - t)
-        + weight_1 * normal_1 * hermite_2(t)
-        - weight_2 * normal_2 * hermite_2(1 - t)
+    return polar_polygon_1 * (1 - t) + polar_polygon_2 * t
+
+
+def get_handle_coefficients(centroid_1, normal_1, centroid_2, normal_2, weight_1, weight_2):
+    """Stack the endpoints and tangents of the cubic Hermite spline that forms the
+    spine of the handle into a 4x3 matrix, so that the spline can be evaluated at
+    many values of t with a single matrix product."""
+    return np.array([
+        centroid_1,
+        centroid_2,
+        weight_1 * normal_1,
+        -weight_2 * normal_2,
+    ])
+
+
+@functools.lru_cache(maxsize=32)
+def get_hermite_bases(num_segments):
+    """Sample the Hermite basis functions at the interior values
+    t = 1 / num_segments, ..., (num_segments - 1) / num_segments. Return the values of
+    t, a 4xn matrix of the basis functions, and a 4xn matrix of their derivatives.
+
+    These depend only on num_segments, so they are cached across invocations of the
+    operator. The returned arrays are read-only."""
+    ts = np.arange(1, num_segments) / num_segments
+    basis = np.stack([
+        hermite_1(ts),
+        hermite_1(1 - ts),
+        hermite_2(ts),
+        hermite_2(1 - ts),
+    ])
+    derivative_basis = np.stack([
+        hermite_1_derivative(ts),
+        -hermite_1_derivative(1 - ts),
+        hermite_2_derivative(ts),
+        -hermite_2_derivative(1 - ts),
+    ])
+    for array in (ts, basis, derivative_basis):
+        array.flags.writeable = False
+    return ts, basis, derivative_basis
+
+
+def get_handle_centroids(centroid_1, normal_1, centroid_2, normal_2, basis, weight_1, weight_2):
+    """Given the centroids and normals of two faces, compute the centroids of the
+    intermediate faces from a matrix of Hermite basis functions sampled at values
+    0 <= t <= 1 (see get_hermite_bases). The result has one row per value of t. The
+    weight parameters control how much the handle sticks out."""
+    coefficients = get_handle_coefficients(
+        centroid_1, normal_1, centroid_2, normal_2, weight_1, weight_2
     )
+    return basis.T @ coefficients
 
 
-def get_handle_normal(centroid_1, normal_1, centroid_2, normal_2, t, weight_1, weight_2):
-    """Like get_handle_centroid, but compute the normal of the face instead of the
-    centroid. This is accomplished by taking the derivative of get_handle_centroid
-    and then normalizing the resulting 3D vector."""
-    return (
-        centroid_1 * hermite_1_derivative(t)
-        + centroid_2 * -hermite_1_derivative(1 - t)
-        + weight_1 * normal_1 * hermite_2_derivative(t)
-        - weight_2 * normal_2 * -hermite_2_derivative(1 - t)
-    ).normalized()
+def get_handle_normals(
+    centroid_1, normal_1, centroid_2, normal_2, derivative_basis, weight_1, weight_2
+):
+    """Like get_handle_centroids, but compute the normals of the faces instead of the
+    centroids. This is accomplished by taking the derivative of the spline and then
+    normalizing each resulting 3D vector."""
+    coefficients = get_handle_coefficients(
+        centroid_1, normal_1, centroid_2, normal_2, weight_1, weight_2
+    )
+    normals = derivative_basis.T @ coefficients
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    return normals
+
+
+def get_handle_rings(
+    points_1_polar,
+    points_2_polar,
+    centroid_1,
+    normal_1,
+    centroid_2,
+    normal_2,
+    num_segments,
+    weight_1,
+    weight_2,
+    rotation_plane_normal,
+    x_axis,
+    y_axis,
+):
+    """Compute the 3D coordinates of the num_segments - 1 intermediate polygonal rings
+    of the handle as an array of shape (num_segments - 1, N, 3). This is pure
+    arithmetic; creating the mesh elements is left to the caller."""
+    ts, basis, derivative_basis = get_hermite_bases(num_segments)
+    # Use a cubic Hermite spline to get the centroids of the polygonal rings, and the
+    # derivative of that cubic Hermite spline to get the normals of the polygons.
+    centroids = get_handle_centroids(
+        centroid_1, normal_1, centroid_2, normal_2, basis, weight_1, weight_2
+    )
+    normals = get_handle_normals(
+        centroid_1, normal_1, centroid_2, normal_2, derivative_basis, weight_1, weight_2
+    )
+    # Interpolate between the two 2D polar polygons for every t at once and reconstruct
+    # 3D polygons orthogonal to the computed normals and centered on the computed
+    # centroids. Rotating a polygon built from the X- and Y-axes is the same as building
+    # it from rotated axes, so we rotate just the two axes of each ring and never the
+    # individual points.
+    polar_polygons = interpolate_polar_polygons(
+        points_1_polar, points_2_polar, ts[:, np.newaxis, np.newaxis]
+    )
+    rotation_matrices = get_rotation_matrices(rotation_plane_normal, normals)
+    x_axes = rotation_matrices @ x_axis
+    y_axes = rotation_matrices @ y_axis
+    result = convert_polar_to_polygon(
+        polar_polygons, x_axes[:, np.newaxis, :], y_axes[:, np.newaxis, :]
+    )
+    result += centroids[:, np.newaxis, :]
+    return result
 
 
 def connect_vertices_with_prism(mesh, vertices_1, vertices_2, flip=False):
@@ -130,67 +228,65 @@ def connect_vertices_with_prism(mesh, vertices_1, vertices_2, flip=False):
         # inside out, and to compensate for this we reverse the order of vertices.
         # This prevents flipped normals.
         return connect_vertices_with_prism(mesh, vertices_2, vertices_1, flip=not flip)
+    # Pair each vertex with its successor around the ring up front, rather than doing
+    # modular index arithmetic for every face.
+    next_vertices_1 = rotate_list(vertices_1, 1)
+    next_vertices_2 = rotate_list(vertices_2, 1)
+    new_face = mesh.faces.new
     result = []
     # Connect with quadrilaterals.
-    for i in range(len(vertices_2)):
-        vertices = [
-            vertices_1[i],
-            vertices_1[(i + 1) % len(vertices_1)],
-            vertices_2[(i + 1) % len(vertices_2)],
-            vertices_2[i],
-        ]
+    for vertex_1, next_vertex_1, vertex_2, next_vertex_2 in zip(
+        vertices_1, next_vertices_1, vertices_2, next_vertices_2
+    ):
+        vertices = [vertex_1, next_vertex_1, next_vertex_2, vertex_2]
         if flip:
             vertices = vertices[::-1]
-        face = mesh.faces.new(vertices)
+        face = new_face(vertices)
         result.append(face)
     # Connect with triangles.
-    for i in range(len(vertices_2), len(vertices_1)):
-        vertices = [
-            vertices_1[i],
-            vertices_1[(i + 1) % len(vertices_1)],
-            vertices_2[0],
-        ]
+    num_quads = len(vertices_2)
+    for vertex_1, next_vertex_1 in zip(vertices_1[num_quads:], next_vertices_1[num_quads:]):
+        vertices = [vertex_1, next_vertex_1, vertices_2[0]]
         if flip:
             vertices = vertices[::-1]
-        face = mesh.faces.new(vertices)
+        face = new_face(vertices)
         result.append(face)
     return result
 
 
-def make_handle(mesh, face_1, vertex_1, face_2, vertex_2, num_segments, weight_1, weight_2, twists=0):
-    if vertex_1 not in face_1.verts:
-        raise RuntimeError("Vertex 1 not in face 1")
-    if vertex_2 not in face_2.verts:
-        raise RuntimeError("Vertex 2 not in face 2")
+@functools.lru_cache(maxsize=32)
+def get_polar_polygons(coordinates_1, centroid_1, normal_1, coordinates_2, centroid_2, normal_2):
+    """Given the vertex coordinates, centroids and normals of two faces, rotate the faces
+    into a common plane and represent them in polar form. Return the two polar polygons
+    as (N, 2) arrays, the normal of the common plane, and the X- and Y-axes of the polar
+    coordinate system.
 
-    normal_1 = face_1.normal
-    normal_2 = -face_2.normal
-
-    centroid_1 = get_centroid(face_1)
-    centroid_2 = get_centroid(face_2)
-
-    original_vertices_1 = face_1.verts[:]
-    shift_1 = original_vertices_1.index(vertex_1)
-    original_vertices_1 = rotate_list(original_vertices_1, shift_1)
-
-    original_vertices_2 = face_2.verts[:]
-    original_vertices_2 = original_vertices_2[::-1]
-    shift_2 = original_vertices_2.index(vertex_2)
-    original_vertices_2 = rotate_list(original_vertices_2, shift_2)
+    The arguments are tuples of floats so that the result can be cached. Blender re-runs
+    the operator from scratch whenever one of its parameters is adjusted, but this part
+    only depends on the geometry of the faces. The returned arrays are read-only."""
+    centroid_1 = np.array(centroid_1)
+    centroid_2 = np.array(centroid_2)
+    normal_1 = np.array(normal_1)
+    normal_2 = np.array(normal_2)
 
     # Translate the two polygons so their centroids are the origin.
-    points_1 = [vertex.co - centroid_1 for vertex in original_vertices_1]
-    points_2 = [vertex.co - centroid_2 for vertex in original_vertices_2]
+    points_1 = np.array(coordinates_1) - centroid_1
+    points_2 = np.array(coordinates_2) - centroid_2
 
-    # Extend the shorter of the two point lists with a duplicated point.
+    # Extend the shorter of the two point arrays with a duplicated point.
     if len(points_1) > len(points_2):
-        points_2.extend([points_2[0]] * (len(points_1) - len(points_2)))
+        points_2 = np.concatenate([
+            points_2, np.repeat(points_2[:1], len(points_1) - len(points_2), axis=0)
+        ])
     elif len(points_2) > len(points_1):
-        points_1.extend([points_1[0]] * (len(points_2) - len(points_1)))
+        points_1 = np.concatenate([
+            points_1, np.repeat(points_1[:1], len(points_2) - len(points_1), axis=0)
+        ])
 
     # Rotate the two polygons so their normals are the same vector. For some reason, that
     # vector is the displacement from one centroid to the other; not clear to me why.
-    rotation_plane_normal = (centroid_2 - centroid_1).normalized()
+    rotation_plane_normal = centroid_2 - centroid_1
+    rotation_plane_normal /= np.linalg.norm(rotation_plane_normal)
     vertices_1 = rotate_polygon_to_new_normal(points_1, normal_1, rotation_plane_normal)
     vertices_2 = rotate_polygon_to_new_normal(points_2, normal_2, rotation_plane_normal)
 
@@ -199,15 +295,15 @@ def make_handle(mesh, face_1, vertex_1, face_2, vertex_2, num_segments, weight_1
     # to rotation_plane_normal. We retrieve the X-axis from one of the edges and the
     # Y-axis is produced with a cross product.
     # We ensure that the edge that we get the X-axis from is nondegenerate, i.e. its
-    # length is not close to zero.
-    for i in range(len(vertices_1)):
-        displacement = vertices_1[(i - 1) % len(vertices_1)] - vertices_1[i]
-        if displacement.length >= 1e-10:
-            x_axis = displacement.normalized()
-            break
-    else:
+    # length is not close to zero, by taking the first edge that is long enough.
+    edges = np.roll(vertices_1, 1, axis=0) - vertices_1
+    edge_lengths = np.linalg.norm(edges, axis=1)
+    nondegenerate = edge_lengths >= 1e-10
+    if not nondegenerate.any():
         raise RuntimeError("All the vertices in one of the faces are bunched together")
-    y_axis = rotation_plane_normal.cross(x_axis)
+    edge_index = np.argmax(nondegenerate)
+    x_axis = edges[edge_index] / edge_lengths[edge_index]
+    y_axis = np.cross(rotation_plane_normal, x_axis)
 
     # Project the two 3D polygons onto the plane and convert them to polar form using the
     # coordinate system.
@@ -217,13 +313,50 @@ def make_handle(mesh, face_1, vertex_1, face_2, vertex_2, num_segments, weight_1
     # If the angle of the first point of polygon 1 is more than 180 degrees from the angle
     # of the angle of the first point of polygon 2, the handle will have an extra twist.
     # Subtracting 2pi from all angles in polygon 2 will untwist it.
-    if points_2_polar[0][1] - points_1_polar[0][1] > math.pi:
-        points_2_polar = [
-            (radius, angle - 2 * math.pi) for radius, angle in points_2_polar
-        ]
-    points_2_polar = [
-        (radius, angle + 2 * math.pi * twists) for radius, angle in points_2_polar
-    ]
+    if points_2_polar[0, 1] - points_1_polar[0, 1] > math.pi:
+        points_2_polar[:, 1] -= 2 * math.pi
+
+    result = (points_1_polar, points_2_polar, rotation_plane_normal, x_axis, y_axis)
+    for array in result:
+        array.flags.writeable = False
+    return result
+
+
+def make_handle(mesh, face_1, vertex_1, face_2, vertex_2, num_segments, weight_1, weight_2, twists=0):
+    if vertex_1 not in face_1.verts:
+        raise RuntimeError("Vertex 1 not in face 1")
+    if vertex_2 not in face_2.verts:
+        raise RuntimeError("Vertex 2 not in face 2")
+
+    # Do all the geometry with NumPy arrays rather than mathutils vectors.
+    normal_1 = np.array(face_1.normal)
+    normal_2 = -np.array(face_2.normal)
+
+    centroid_1 = np.array(get_centroid(face_1))
+    centroid_2 = np.array(get_centroid(face_2))
+
+    original_vertices_1 = face_1.verts[:]
+    shift_1 = original_vertices_1.index(vertex_1)
+    original_vertices_1 = rotate_list(original_vertices_1, shift_1)
+
+    original_vertices_2 = face_2.verts[:]
+    original_vertices_2 = original_vertices_2[::-1]
+    shift_2 = original_vertices_2.index(vertex_2)
+    original_vertices_2 = rotate_list(original_vertices_2, shift_2)
+
+    # Project the faces into polar form. This is cached on the face geometry, so the
+    # twists are added afterwards to a copy of the second polygon.
+    points_1_polar, points_2_polar, rotation_plane_normal, x_axis, y_axis = (
+        get_polar_polygons(
+            tuple(tuple(vertex.co) for vertex in original_vertices_1),
+            tuple(centroid_1),
+            tuple(normal_1),
+            tuple(tuple(vertex.co) for vertex in original_vertices_2),
+            tuple(centroid_2),
+            tuple(normal_2),
+        )
+    )
+    points_2_polar = points_2_polar + [0.0, 2 * math.pi * twists]
 
     # Set up a 2D list of vertices. Each item of rings corresponds to a ring of vertices
     # forming a polygonal cross section of the handle. We will be creating new vertices
@@ -231,29 +364,27 @@ def make_handle(mesh, face_1, vertex_1, face_2, vertex_2, num_segments, weight_1
     # two original faces.
     rings = [original_vertices_1]
 
-    ts = [i / num_segments for i in range(1, num_segments)]
-    for t in ts:
-        # Use a cubic Hermite spline to get the centroid of the polygonal ring.
-        centroid = get_handle_centroid(
-            centroid_1, normal_1, centroid_2, normal_2, t, weight_1, weight_2
-        )
-        # Use the derivative of that cubic Hermite spline to get the normal of the polygon.
-        normal = get_handle_normal(
-            centroid_1, normal_1, centroid_2, normal_2, t, weight_1, weight_2
-        )
-        # Interpolate between the two 2D polar polygons and reconstruct a 3D polygon
-        # orthogonal to the computed normal and centered on the computed centroid.
-        polygon_polar = interpolate_polar_polygons(points_1_polar, points_2_polar, t)
-        polygon = convert_polar_to_polygon(polygon_polar, x_axis, y_axis)
-        polygon = rotate_polygon_to_new_normal(polygon, rotation_plane_normal, normal)
-        polygon = [point + centroid for point in polygon]
-
-        # Create vertices for each of the points.
-        segment = []
-        for point in polygon:
-            new_vertex = mesh.verts.new(point)
-            segment.append(new_vertex)
-        rings.append(segment)
+    # Compute the coordinates of all the intermediate rings up front, then create a
+    # vertex for each of the points.
+    ring_points = get_handle_rings(
+        points_1_polar,
+        points_2_polar,
+        centroid_1,
+        normal_1,
+        centroid_2,
+        normal_2,
+        num_segments,
+        weight_1,
+        weight_2,
+        rotation_plane_normal,
+        x_axis,
+        y_axis,
+    )
+    # Converting the whole array to nested lists in one go is much cheaper than handing
+    # bmesh one NumPy row at a time.
+    new_vertex = mesh.verts.new
+    for polygon in ring_points.tolist():
+        rings.append([new_vertex(point) for point in polygon])
 
     # Add the vertices from the second face.
     rings.append(original_vertices_2)